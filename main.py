@@ -1,10 +1,14 @@
 import json
 import re
+import sys
+import asyncio
 import time
 import datetime
-from collections import deque
-from typing import Dict
-from dataclasses import dataclass, field
+import hashlib
+import heapq
+from collections import OrderedDict, deque
+from typing import Any, Dict
+from dataclasses import dataclass, field, replace
 
 import astrbot.api.star as star
 from astrbot.api.event import AstrMessageEvent, filter
@@ -39,6 +43,21 @@ class RawMessage:
     content: str
     timestamp: float
     is_bot: bool = False
+    # 渲染到判断提示词对话历史中的单行文本，写入时生成一次，之后每次判断直接复用
+    line: str = field(init=False, repr=False)
+
+    def __post_init__(self):
+        prefix = "[机器人]" if self.is_bot else f"[{self.sender_name}]"
+        self.line = f"{prefix}: {self.content}"
+
+
+@dataclass
+class JudgeInputs:
+    """一次判断所需的上下文视图，由同一份缓冲区快照派生"""
+    chat_context: str
+    recent_messages: str
+    last_bot_reply: str | None
+    recent_contexts: list
 
 
 @dataclass
@@ -46,43 +65,116 @@ class ChatState:
     """群聊状态数据类"""
     energy: float = 1.0
     last_reply_time: float = 0.0
+    # 精力按时间恢复的计时起点，与真实的最后回复时间分开记录
+    energy_updated_at: float = 0.0
     last_reset_date: str = ""
     total_messages: int = 0
     total_replies: int = 0
 
+    @property
+    def reply_rate(self) -> float:
+        """历史回复率（百分比）"""
+        return 0.0 if self.total_messages == 0 else self.total_replies / self.total_messages * 100.0
+
+
+# 会话显式取消人格时 persona_id 的取值
+_PERSONA_NONE = sys.intern("[%None]")
+
+# /heartflow_cache 报告的标题，以及缓存为空时的完整回复
+_CACHE_REPORT_HEADER = "🧠 系统提示词缓存状态\n\n"
+_CACHE_REPORT_EMPTY = _CACHE_REPORT_HEADER + "📭 当前无缓存记录"
+
+# 判断缓存键：(人格提示词摘要, 群聊ID, 归一化消息, 上次机器人回复)
+JudgeCacheKey = tuple[bytes, str, str, str | None]
+
+# 五个评分维度，权重向量与分数按此顺序排列
+_SCORE_KEYS = ("relevance", "willingness", "social", "timing", "continuity")
+
+
+class LRUDict(OrderedDict):
+    """容量受限的 LRU 字典：读写时刷新顺序，超出容量时淘汰最久未使用的条目"""
+
+    def __init__(self, maxsize: int, *args, **kwargs):
+        self.maxsize = maxsize
+        super().__init__(*args, **kwargs)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        self._evict()
+
+    def resize(self, maxsize: int) -> None:
+        """调整容量，缩小时立即淘汰多余的条目"""
+        self.maxsize = maxsize
+        self._evict()
 
-def _extract_json(text: str) -> dict:
-    """从模型返回的文本中稳健地提取 JSON 对象。
+    def _evict(self) -> None:
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+# 预编译：markdown 代码块包裹的 JSON 与最外层 {...}
+_JSON_FENCE = re.compile(r"^```(?:json)?\s*(.*?)\s*```$", re.DOTALL | re.IGNORECASE)
+_JSON_OBJECT = re.compile(r"\{.*\}", re.DOTALL)
+
+
+def _extract_json(text: str) -> Any:
+    """从模型返回的文本中稳健地提取 JSON 值（通常为对象，调用方需自行校验类型）。
 
     依次尝试：
-    1. 直接解析
-    2. 去除 markdown 代码块后解析
-    3. 正则提取第一个 {...} 子串后解析
+    1. 去除 markdown 代码块（如有）后直接解析
+    2. 正则提取第一个 {...} 子串后解析
     """
     text = text.strip()
 
-    # 1. 直接尝试
-    try:
-        return json.loads(text)
-    except json.JSONDecodeError:
-        pass
-
-    # 2. 去除 markdown 代码块
-    cleaned = re.sub(r"^```(?:json)?\s*", "", text, flags=re.IGNORECASE)
-    cleaned = re.sub(r"\s*```$", "", cleaned).strip()
+    # 1. 一次匹配去除 markdown 代码块，无代码块时即为原文
+    fence = _JSON_FENCE.match(text)
+    body = fence.group(1) if fence else text
     try:
-        return json.loads(cleaned)
+        return json.loads(body)
     except json.JSONDecodeError:
         pass
 
-    # 3. 正则提取最外层 {...}
-    match = re.search(r"\{.*\}", cleaned, re.DOTALL)
+    # 2. 正则提取最外层 {...}
+    match = _JSON_OBJECT.search(body)
     if match:
         return json.loads(match.group())
 
     raise ValueError(f"无法从文本中提取有效 JSON: {text[:200]}")
 
 
+def _digest_prompt(prompt: str) -> bytes:
+    """计算提示词的 16 字节 blake2b 摘要，用于缓存比对而无需保存原文。"""
+    return hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+
+
+# 人格提示词短于此长度时直接使用原文：精简结果本身约 100-200 字，再短的提示词精简后并不划算
+_SUMMARIZE_MIN_LENGTH = 600
+
+# 超过此长度的文本在线程池中计算摘要，避免阻塞事件循环
+_OFFLOAD_DIGEST_THRESHOLD = 16_000
+
+# 本地预判直接放行所需的最短消息长度，更短的消息即使评分很高也交给小模型判断
+_LOCAL_ACCEPT_MIN_LENGTH = 6
+
+
+async def _digest_prompt_async(prompt: str) -> bytes:
+    """计算提示词摘要，超长文本交给线程池处理。"""
+    if len(prompt) > _OFFLOAD_DIGEST_THRESHOLD:
+        return await asyncio.to_thread(_digest_prompt, prompt)
+    return _digest_prompt(prompt)
+
+
+def _normalize_message(text: str) -> str:
+    """归一化消息文本（去首尾空白、小写、合并连续空白），用于判断缓存键。"""
+    return " ".join(text.lower().split())
+
+
 def _clamp_score(v) -> float:
     """将模型返回的分数值钉位到 [0, 10]。"""
     try:
@@ -91,12 +183,85 @@ def _clamp_score(v) -> float:
         return 0.0
 
 
+# 判断提示词由 开头 + 静态主体 + JSON 提醒 + 动态内容 + 结尾 拼接而成，重试时只替换 JSON 提醒，
+# 其前面的开头与静态主体保持不变，提供商侧的前缀缓存在重试时依然有效
+_JUDGE_PROMPT_PREAMBLE = "你是一个专业的群聊回复决策系统，能够准确判断消息价值和回复时机。"
+
+_JUDGE_JSON_HINT = "\n**重要提醒：你必须严格按照JSON格式返回结果，不要包含任何其他内容！请不要进行对话，只返回JSON！**\n"
+
+_JUDGE_JSON_HINT_RETRY = "\n**重要提醒：你必须严格按照JSON格式返回结果，不要包含任何其他内容！请不要进行对话，只返回JSON！这是第{attempt}次尝试，请确保返回有效的JSON格式！**\n"
+
+# 判断提示词的静态主体（不随消息变化），在插件初始化时填入配置后冻结复用
+_JUDGE_PROMPT_TEMPLATE = """
+
+你是群聊机器人的决策系统，需要判断是否应该主动回复下方的待判断消息。
+
+## 评估要求
+请从以下5个维度评估（0-10分），**重要提醒：基于下方的机器人角色设定来判断是否适合回复**：
+
+1. **内容相关度**(0-10)：消息是否有趣、有价值、适合我回复
+   - 考虑消息的质量、话题性、是否需要回应
+   - 识别并过滤垃圾消息、无意义内容
+   - **结合机器人角色特点，判断是否符合角色定位**
+
+2. **回复意愿**(0-10)：基于当前状态，我回复此消息的意愿
+   - 考虑当前精力水平和心情状态
+   - 考虑今日回复频率控制
+   - **基于机器人角色设定，判断是否应该主动参与此话题**
+
+3. **社交适宜性**(0-10)：在当前群聊氛围下回复是否合适
+   - 考虑群聊活跃度和讨论氛围
+   - **考虑机器人角色在群中的定位和表现方式**
+
+4. **时机恰当性**(0-10)：回复时机是否恰当
+   - 考虑距离上次回复的时间间隔
+   - 考虑消息的紧急性和时效性
+
+5. **对话连贯性**(0-10)：当前消息与上次机器人回复的关联程度
+   - 如果当前消息是对上次回复的回应或延续，应给高分
+   - 如果当前消息与上次回复完全无关，给中等分数
+   - 如果没有上次回复记录，给默认分数5分
+
+**回复阈值**: {reply_threshold} (综合评分达到此分数才回复)
+
+**重要！！！请严格按照以下JSON格式回复，不要添加任何其他内容：**
+
+请以JSON格式回复：
+{schema_block}
+"""
+
+# 判断结果的 JSON 格式说明，按是否要求返回理由预先写好两份
+_JUDGE_SCHEMA_NO_REASON = """{
+    "relevance": 分数,
+    "willingness": 分数,
+    "social": 分数,
+    "timing": 分数,
+    "continuity": 分数
+}"""
+
+_JUDGE_SCHEMA_WITH_REASON = """{
+    "relevance": 分数,
+    "willingness": 分数,
+    "social": 分数,
+    "timing": 分数,
+    "continuity": 分数,
+    "reasoning": "详细分析原因，说明为什么应该或不应该回复，需要结合机器人角色特点进行分析，特别说明与上次回复的关联性"
+}"""
+
+_JUDGE_PROMPT_SUFFIX = """
+**注意：你的回复必须是完整的JSON对象，不要包含任何解释性文字或其他内容！**
+"""
+
+
 class HeartflowPlugin(star.Star):
 
     def __init__(self, context: star.Context, config):
         super().__init__(context)
         self.config = config
 
+        # 插件开关（每条群消息都会检查，初始化时读取一次）
+        self.enable_heartflow = bool(self.config.get("enable_heartflow", False))
+
         # 判断模型配置
         self.judge_provider_name = self.config.get("judge_provider_name", "")
 
@@ -107,24 +272,55 @@ class HeartflowPlugin(star.Star):
         self.context_messages_count = self.config.get("context_messages_count", 5)
         self.judge_context_count = self.config.get("judge_context_count", self.context_messages_count)
         self.min_reply_interval = self.config.get("min_reply_interval_seconds", 0)
-        self.whitelist_enabled = self.config.get("whitelist_enabled", False)
-        self.chat_whitelist = self.config.get("chat_whitelist", [])
+        self.whitelist_enabled = bool(self.config.get("whitelist_enabled", False))
+        self.chat_whitelist = frozenset(self.config.get("chat_whitelist", []) or [])
 
-        # 群聊状态管理
-        self.chat_states: Dict[str, ChatState] = {}
+        # 群聊状态管理（按最近活跃淘汰，内存只与活跃群聊数相关）
+        self.chat_states: Dict[str, ChatState] = LRUDict(2048)
 
         # 原始群聊消息缓冲区：{unified_msg_origin: deque[RawMessage]}
         # 记录所有群聊原始消息（无论是否触发 LLM），用于判断上下文
-        self._raw_msg_buffer: Dict[str, deque] = {}
+        self._raw_msg_buffer: Dict[str, deque] = LRUDict(2048)
+        # 每个群聊最近一条机器人回复及其之后的用户消息数，写入缓冲区时增量维护
+        self._last_bot_msg: Dict[str, RawMessage] = LRUDict(2048)
+        self._msgs_since_bot_reply: Dict[str, int] = LRUDict(2048)
         self._raw_msg_buffer_size = max(self.context_messages_count, self.judge_context_count) * 4  # 缓冲区保留更多条以备用
 
-        # 系统提示词缓存：{conversation_id: {"original": str, "summarized": str, "persona_id": str}}
-        self.system_prompt_cache: Dict[str, Dict[str, str]] = {}
+        # 系统提示词缓存：{persona_id: {"orig_hash": bytes, "orig_len": int, "summarized": str, "persona_id": str}}
+        # 只保存原始提示词的摘要和长度，不保存原文
+        self.system_prompt_cache: Dict[str, dict] = LRUDict(max(1, self.config.get("system_prompt_cache_max", 512)))
+        # 正在后台进行的提示词总结任务：{persona_id: Task}
+        self._summarize_tasks: Dict[str, asyncio.Task] = {}
+
+        # 人格提示词索引：{persona_id: system_prompt}，按需填充，人格数量变化时整体失效
+        self._persona_prompt_index: Dict[str, str] | None = None
+        self._persona_prompt_index_len = -1
+
+        # 会话人格提示词缓存：{unified_msg_origin: (curr_cid, persona_id, prompt)}，会话ID与人格ID均不变时直接复用
+        self._persona_prompt_lru: Dict[str, tuple[str | None, str | None, str]] = LRUDict(512)
 
         # 判断配置
         self.judge_include_reasoning = self.config.get("judge_include_reasoning", True)
         self.judge_max_retries = max(0, self.config.get("judge_max_retries", 3))  # 确保最小为0
-        
+
+        # 判断结果缓存：{(人格摘要, 群聊ID, 归一化消息, 上次机器人回复): (写入时间, JudgeResult)}
+        # LRU + TTL，命中时跳过小模型调用
+        self.judge_cache: OrderedDict[JudgeCacheKey, tuple[float, JudgeResult]] = OrderedDict()
+        self.judge_cache_ttl = max(0, self.config.get("judge_cache_ttl_seconds", 60))  # 0 表示关闭
+        self.judge_cache_size = 1024
+
+        # 本地规则预判：本地评分与回复阈值相差超过此值时不调用小模型，0 表示关闭
+        self.local_gate_margin = max(0.0, self.config.get("local_gate_margin", 0.25))
+
+        # 判断批处理：每个群聊一个队列和一个工作协程，窗口期内到达的消息合并为一次小模型调用
+        self.judge_batch_window = max(0, self.config.get("judge_batch_window_ms", 200)) / 1000.0  # 0 表示关闭
+        self.judge_batch_size = max(1, self.config.get("judge_batch_size", 5))
+        self._judge_queues: Dict[str, asyncio.Queue] = {}
+        self._judge_workers: Dict[str, asyncio.Task] = {}
+
+        # 时钟缓存：(计算时的时间戳, ("HH:MM", "HH:MM:SS", "YYYY-MM-DD"))，1 秒内复用，避免频繁格式化时间
+        self._clock_cache: tuple[float, tuple[str, str, str] | None] = (0.0, None)
+
         # 判断权重配置
         self.weights = {
             "relevance": self.config.get("judge_relevance", 0.25),
@@ -140,53 +336,81 @@ class HeartflowPlugin(star.Star):
             # 进行归一化处理
             self.weights = {k: v / weight_sum for k, v in self.weights.items()}
             logger.info(f"判断权重和已归一化，当前配置为: {self.weights}")
+        # 冻结为按 _SCORE_KEYS 排列的权重向量，计算综合评分时直接与分数逐项相乘
+        self._weight_vec = tuple(self.weights[k] for k in _SCORE_KEYS)
+
+        # 预先生成判断提示词的静态前缀
+        self._schema_block = _JUDGE_SCHEMA_WITH_REASON if self.judge_include_reasoning else _JUDGE_SCHEMA_NO_REASON
+        self._judge_prompt_body = _JUDGE_PROMPT_TEMPLATE.format_map({
+            "reply_threshold": self.reply_threshold,
+            "schema_block": self._schema_block,
+        })
 
         logger.info("心流插件已初始化")
 
     async def _get_or_create_summarized_system_prompt(self, event: AstrMessageEvent, original_prompt: str) -> str:
         """获取或创建精简版系统提示词"""
         try:
+            conv_mgr = self.context.conversation_manager
+            umo = event.unified_msg_origin
+
             # 获取当前会话ID
-            curr_cid = await self.context.conversation_manager.get_curr_conversation_id(event.unified_msg_origin)
+            curr_cid = await conv_mgr.get_curr_conversation_id(umo)
             if not curr_cid:
                 return original_prompt
             
             # 获取当前人格ID作为缓存键（仅用 persona_id，不包含 cid）
             # cid 随对话切换会变，但提示词是按人格存的，缓存键不应包含 cid
-            conversation = await self.context.conversation_manager.get_conversation(event.unified_msg_origin, curr_cid)
+            conversation = await conv_mgr.get_conversation(umo, curr_cid)
             persona_id = (conversation.persona_id if conversation else None) or "default"
 
             # 构建缓存键
             cache_key = persona_id
-            
+
+            # 原始提示词不够长时精简不划算，直接返回
+            if not original_prompt or len(original_prompt.strip()) < _SUMMARIZE_MIN_LENGTH:
+                return original_prompt
+
             # 检查缓存
+            orig_hash = None
             if cache_key in self.system_prompt_cache:
                 cached = self.system_prompt_cache[cache_key]
-                # 如果原始提示词没有变化，返回缓存的总结
-                if cached.get("original") == original_prompt:
+                # 如果原始提示词没有变化（先比长度，再比摘要），返回缓存的总结
+                if cached.get("orig_len") == len(original_prompt):
+                    orig_hash = await _digest_prompt_async(original_prompt)
+                if orig_hash is not None and cached.get("orig_hash") == orig_hash:
                     logger.debug(f"使用缓存的精简系统提示词: {cache_key}")
                     return cached.get("summarized", original_prompt)
             
-            # 如果没有缓存或原始提示词发生变化，进行总结
-            if not original_prompt or len(original_prompt.strip()) < 50:
-                # 如果原始提示词太短，直接返回
-                return original_prompt
+            # 如果没有缓存或原始提示词发生变化，在后台进行总结，本次先使用原始提示词
+            if cache_key not in self._summarize_tasks:
+                self._summarize_tasks[cache_key] = asyncio.create_task(
+                    self._summarize_and_cache(cache_key, original_prompt)
+                )
+            return original_prompt
             
+        except Exception as e:
+            logger.error(f"获取精简系统提示词失败: {e}")
+            return original_prompt
+
+    async def _summarize_and_cache(self, cache_key: str, original_prompt: str) -> None:
+        """后台总结系统提示词并写入缓存"""
+        try:
             summarized_prompt = await self._summarize_system_prompt(original_prompt)
-            
+
             # 更新缓存
             self.system_prompt_cache[cache_key] = {
-                "original": original_prompt,
+                "orig_hash": await _digest_prompt_async(original_prompt),
+                "orig_len": len(original_prompt),
                 "summarized": summarized_prompt,
-                "persona_id": persona_id
+                "persona_id": cache_key
             }
 
             logger.info(f"创建新的精简系统提示词: [{cache_key}] | 原长度:{len(original_prompt)} -> 新长度:{len(summarized_prompt)}")
-            return summarized_prompt
-            
         except Exception as e:
-            logger.error(f"获取精简系统提示词失败: {e}")
-            return original_prompt
+            logger.error(f"后台总结系统提示词失败: {e}")
+        finally:
+            self._summarize_tasks.pop(cache_key, None)
     
     async def _summarize_system_prompt(self, original_prompt: str) -> str:
         """使用小模型对系统提示词进行总结"""
@@ -239,20 +463,27 @@ class HeartflowPlugin(star.Star):
 
     async def judge_with_tiny_model(self, event: AstrMessageEvent) -> JudgeResult:
         """使用小模型进行智能判断"""
+        return (await self.judge_batch_with_tiny_model([event]))[0]
+
+    async def judge_batch_with_tiny_model(self, events: list[AstrMessageEvent]) -> list[JudgeResult]:
+        """使用小模型对同一群聊的一批消息进行判断，一次调用返回每条消息的结果"""
 
         if not self.judge_provider_name:
             logger.warning("小参数判断模型提供商名称未配置，跳过心流判断")
-            return JudgeResult(should_reply=False, reasoning="提供商未配置")
+            return [JudgeResult(should_reply=False, reasoning="提供商未配置") for _ in events]
 
         # 获取指定的 provider
         try:
             judge_provider = self.context.get_provider_by_id(self.judge_provider_name)
             if not judge_provider:
                 logger.warning(f"未找到提供商: {self.judge_provider_name}")
-                return JudgeResult(should_reply=False, reasoning=f"提供商不存在: {self.judge_provider_name}")
+                return [JudgeResult(should_reply=False, reasoning=f"提供商不存在: {self.judge_provider_name}") for _ in events]
         except Exception as e:
             logger.error(f"获取提供商失败: {e}")
-            return JudgeResult(should_reply=False, reasoning=f"获取提供商失败: {str(e)}")
+            return [JudgeResult(should_reply=False, reasoning=f"获取提供商失败: {str(e)}") for _ in events]
+
+        # 以最新一条消息作为群聊上下文的基准
+        event = events[-1]
 
         # 获取群聊状态
         chat_state = self._get_chat_state(event.unified_msg_origin)
@@ -261,22 +492,51 @@ class HeartflowPlugin(star.Star):
         original_persona_prompt = await self._get_persona_system_prompt(event)
         logger.debug(f"小参数模型获取原始人格提示词: {'有' if original_persona_prompt else '无'} | 长度: {len(original_persona_prompt) if original_persona_prompt else 0}")
         
+        last_bot_reply = self._get_last_bot_reply(event)
+
+        # 命中判断缓存的消息直接使用缓存结果，只有未命中的消息才交给小模型
+        persona_digest = await _digest_prompt_async(original_persona_prompt or "")
+        cache_keys = [self._judge_cache_key(e, persona_digest, last_bot_reply) for e in events]
+        results: list[JudgeResult | None] = [self._judge_cache_get(key) for key in cache_keys]
+        pending = [i for i, r in enumerate(results) if r is None]
+        if len(pending) < len(events):
+            logger.debug(f"命中判断缓存: {event.unified_msg_origin[:20]}... | {len(events) - len(pending)}/{len(events)} 条")
+
+        # 本地规则预判：明显不该回复或明显该回复的消息直接给出结果，只有不确定的才交给小模型
+        if self.local_gate_margin > 0:
+            for i in pending:
+                results[i] = self._local_gate(events[i], chat_state, last_bot_reply)
+            pending = [i for i in pending if results[i] is None]
+
+        if not pending:
+            return self._limit_batch_replies(results)
+
         # 获取或创建精简版系统提示词
         persona_system_prompt = await self._get_or_create_summarized_system_prompt(event, original_persona_prompt)
         logger.debug(f"小参数模型使用精简人格提示词: {'有' if persona_system_prompt else '无'} | 长度: {len(persona_system_prompt) if persona_system_prompt else 0}")
 
-        # 构建判断上下文
-        chat_context = self._build_chat_context(event)
-        recent_messages = self._get_recent_messages(event)
-        last_bot_reply = self._get_last_bot_reply(event)
+        # 构建判断上下文，对话历史截止到本批第一条待判断消息之前
+        inputs = self._gather_judge_inputs(event, events[pending[0]])
 
-        reasoning_part = ""
-        if self.judge_include_reasoning:
-            reasoning_part = ',\n    "reasoning": "详细分析原因，说明为什么应该或不应该回复，需要结合机器人角色特点进行分析，特别说明与上次回复的关联性"'
+        if len(pending) == 1:
+            pending_event = events[pending[0]]
+            pending_block = f"""## 待判断消息
+发送者: {pending_event.get_sender_name()}
+内容: {pending_event.message_str}
+时间: {self._now_strings()[1]}
+"""
+        else:
+            lines = [f"[{n}] 发送者: {events[i].get_sender_name()} | 内容: {events[i].message_str}" for n, i in enumerate(pending, 1)]
+            pending_block = f"""## 待判断消息（共{len(pending)}条，按时间顺序）
+{chr(10).join(lines)}
+时间: {self._now_strings()[1]}
 
-        judge_prompt = f"""
-你是群聊机器人的决策系统，需要判断是否应该主动回复以下消息。
+**本次需要对以上{len(pending)}条消息分别评估，请以如下JSON格式回复，results 数组按消息顺序排列，每个元素均为上述格式的JSON对象：**
+{{"results": [第1条消息的评估, 第2条消息的评估, ...]}}
+"""
 
+        # 仅构建随消息变化的动态部分，静态的评估要求与 JSON 格式已在初始化时预先生成
+        dynamic_tail = f"""
 ## 机器人角色设定
 {persona_system_prompt if persona_system_prompt else "默认角色：智能助手"}
 
@@ -286,71 +546,20 @@ class HeartflowPlugin(star.Star):
 - 上次发言: {self._get_minutes_since_last_reply(event.unified_msg_origin)}分钟前
 
 ## 群聊基本信息
-{chat_context}
+{inputs.chat_context}
 
 ## 最近{self.context_messages_count}条对话历史
-{recent_messages}
+{inputs.recent_messages}
 
 ## 上次机器人回复
-{last_bot_reply if last_bot_reply else "暂无上次回复记录"}
+{inputs.last_bot_reply if inputs.last_bot_reply else "暂无上次回复记录"}
 
-## 待判断消息
-发送者: {event.get_sender_name()}
-内容: {event.message_str}
-时间: {datetime.datetime.now().strftime('%H:%M:%S')}
-
-## 评估要求
-请从以下5个维度评估（0-10分），**重要提醒：基于上述机器人角色设定来判断是否适合回复**：
-
-1. **内容相关度**(0-10)：消息是否有趣、有价值、适合我回复
-   - 考虑消息的质量、话题性、是否需要回应
-   - 识别并过滤垃圾消息、无意义内容
-   - **结合机器人角色特点，判断是否符合角色定位**
-
-2. **回复意愿**(0-10)：基于当前状态，我回复此消息的意愿
-   - 考虑当前精力水平和心情状态
-   - 考虑今日回复频率控制
-   - **基于机器人角色设定，判断是否应该主动参与此话题**
-
-3. **社交适宜性**(0-10)：在当前群聊氛围下回复是否合适
-   - 考虑群聊活跃度和讨论氛围
-   - **考虑机器人角色在群中的定位和表现方式**
-
-4. **时机恰当性**(0-10)：回复时机是否恰当
-   - 考虑距离上次回复的时间间隔
-   - 考虑消息的紧急性和时效性
-
-5. **对话连贯性**(0-10)：当前消息与上次机器人回复的关联程度
-   - 如果当前消息是对上次回复的回应或延续，应给高分
-   - 如果当前消息与上次回复完全无关，给中等分数
-   - 如果没有上次回复记录，给默认分数5分
-
-**回复阈值**: {self.reply_threshold} (综合评分达到此分数才回复)
-
-**重要！！！请严格按照以下JSON格式回复，不要添加任何其他内容：**
-
-请以JSON格式回复：
-{{
-    "relevance": 分数,
-    "willingness": 分数,
-    "social": 分数,
-    "timing": 分数,
-    "continuity": 分数{reasoning_part}
-}}
-
-**注意：你的回复必须是完整的JSON对象，不要包含任何解释性文字或其他内容！**
-"""
+{pending_block}"""
 
         try:
-            # 构建完整的判断提示词，将系统提示直接整合到prompt中
-            complete_judge_prompt = "你是一个专业的群聊回复决策系统，能够准确判断消息价值和回复时机。"
-            if persona_system_prompt:
-                complete_judge_prompt += f"\n\n你正在为以下角色的机器人做决策：\n{persona_system_prompt}"
-            complete_judge_prompt += "\n\n**重要提醒：你必须严格按照JSON格式返回结果，不要包含任何其他内容！请不要进行对话，只返回JSON！**\n\n"
-            complete_judge_prompt += judge_prompt
-
-            # 提前计算对话历史上下文（循环外只算一次）
-            recent_contexts = self._get_recent_contexts(event)
+            # 静态前缀在前、动态内容在后，便于提供商侧复用前缀缓存
+            # 第三段为 JSON 提醒，重试时只替换这一段，不影响其前面的静态前缀
+            prompt_parts = [_JUDGE_PROMPT_PREAMBLE, self._judge_prompt_body, _JUDGE_JSON_HINT, dynamic_tail, _JUDGE_PROMPT_SUFFIX]
 
             # 重试机制：使用配置的重试次数
             max_retries = self.judge_max_retries + 1
@@ -360,8 +569,8 @@ class HeartflowPlugin(star.Star):
             for attempt in range(max_retries):
                 try:
                     llm_response = await judge_provider.text_chat(
-                        prompt=complete_judge_prompt,
-                        contexts=recent_contexts,
+                        prompt="".join(prompt_parts),
+                        contexts=inputs.recent_contexts,
                         image_urls=[],
                     )
 
@@ -370,40 +579,30 @@ class HeartflowPlugin(star.Star):
 
                     judge_data = _extract_json(content)
 
-                    # 直接从 JSON 根对象获取分数，并钉位到 [0, 10]
-                    relevance = _clamp_score(judge_data.get("relevance", 0))
-                    willingness = _clamp_score(judge_data.get("willingness", 0))
-                    social = _clamp_score(judge_data.get("social", 0))
-                    timing = _clamp_score(judge_data.get("timing", 0))
-                    continuity = _clamp_score(judge_data.get("continuity", 0))
-                    
-                    # 计算综合评分
-                    overall_score = (
-                        relevance * self.weights["relevance"] +
-                        willingness * self.weights["willingness"] +
-                        social * self.weights["social"] +
-                        timing * self.weights["timing"] +
-                        continuity * self.weights["continuity"]
-                    ) / 10.0
-
-                    # 根据综合评分判断是否应该回复
-                    should_reply = overall_score >= self.reply_threshold
-
-                    logger.debug(f"小参数模型判断成功，综合评分: {overall_score:.3f}, 是否回复: {should_reply}")
-
-                    return JudgeResult(
-                        relevance=relevance,
-                        willingness=willingness,
-                        social=social,
-                        timing=timing,
-                        continuity=continuity,
-                        reasoning=judge_data.get("reasoning", "") if self.judge_include_reasoning else "",
-                        should_reply=should_reply,
-                        confidence=overall_score,  # 使用综合评分作为置信度
-                        overall_score=overall_score,
-                        related_messages=[]  # 不再使用关联消息功能
-                    )
-                    
+                    if len(pending) == 1:
+                        if not isinstance(judge_data, dict):
+                            raise ValueError("判断结果不是 JSON 对象")
+                        items = [judge_data]
+                    else:
+                        # 兼容模型直接返回数组而非 {"results": [...]} 的情况
+                        if isinstance(judge_data, list):
+                            items = judge_data
+                        elif isinstance(judge_data, dict):
+                            items = judge_data.get("results")
+                        else:
+                            raise ValueError("批量判断结果不是 JSON 对象或数组")
+                        if not isinstance(items, list) or len(items) != len(pending) or not all(isinstance(it, dict) for it in items):
+                            raise ValueError(f"批量判断结果数量不匹配: 期望{len(pending)}条")
+
+                    for i, item in zip(pending, items):
+                        results[i] = self._build_judge_result(item)
+
+                    # 在同批次回复限制之后再写入缓存，被降级的消息不会在重复出现时触发回复
+                    results = self._limit_batch_replies(results)
+                    for i in pending:
+                        self._judge_cache_put(cache_keys[i], results[i])
+                    return results
+
                 except (json.JSONDecodeError, ValueError) as e:
                     logger.warning(f"小参数模型返回JSON解析失败 (尝试 {attempt + 1}/{max_retries}): {str(e)}")
                     logger.warning(f"无法解析的内容: {content[:500]}...")
@@ -411,31 +610,219 @@ class HeartflowPlugin(star.Star):
                     if attempt == max_retries - 1:
                         # 最后一次尝试失败，返回失败结果
                         logger.error(f"小参数模型重试{self.judge_max_retries}次后仍然返回无效JSON，放弃处理")
-                        return JudgeResult(should_reply=False, reasoning=f"JSON解析失败，重试{self.judge_max_retries}次")
+                        failed = JudgeResult(should_reply=False, reasoning=f"JSON解析失败，重试{self.judge_max_retries}次")
+                        return [r if r is not None else failed for r in results]
                     else:
                         # 还有重试机会，添加更强的提示
-                        complete_judge_prompt = complete_judge_prompt.replace(
-                            "**重要提醒：你必须严格按照JSON格式返回结果，不要包含任何其他内容！请不要进行对话，只返回JSON！**",
-                            f"**重要提醒：你必须严格按照JSON格式返回结果，不要包含任何其他内容！请不要进行对话，只返回JSON！这是第{attempt + 2}次尝试，请确保返回有效的JSON格式！**"
-                        )
+                        prompt_parts[2] = _JUDGE_JSON_HINT_RETRY.format(attempt=attempt + 2)
                         continue
 
         except Exception as e:
             logger.error(f"小参数模型判断异常: {e}")
-            return JudgeResult(should_reply=False, reasoning=f"异常: {str(e)}")
+            failed = JudgeResult(should_reply=False, reasoning=f"异常: {str(e)}")
+            return [r if r is not None else failed for r in results]
+
+    def _local_score(self, event: AstrMessageEvent, chat_state: ChatState, last_bot_reply: str | None) -> float:
+        """根据本地信号粗略估计回复价值（0-1）：精力、距上次回复时间、消息长度、是否提问、是否在接机器人的话"""
+        message = event.message_str.strip()
+        recency = min(1.0, self._get_minutes_since_last_reply(event.unified_msg_origin) / 30.0)
+        length = min(1.0, len(message) / 30.0)
+        question = 1.0 if "?" in message or "？" in message else 0.0
+        msgs_since_bot = event.get_extra("heartflow_msgs_since_bot")
+        if msgs_since_bot is None:
+            _, msgs_since_bot = self._get_last_bot_msg(event.unified_msg_origin)
+        continuing = 1.0 if last_bot_reply and msgs_since_bot <= 2 else 0.0
+        # 保留两位小数，避免浮点误差让恰好落在边界上的评分越过预判阈值
+        return round(
+            chat_state.energy * 0.3 +
+            recency * 0.2 +
+            length * 0.15 +
+            question * 0.2 +
+            continuing * 0.15,
+            2,
+        )
+
+    def _local_gate(self, event: AstrMessageEvent, chat_state: ChatState, last_bot_reply: str | None) -> JudgeResult | None:
+        """本地评分明显低于或高于回复阈值时直接给出判断结果，落在不确定区间时返回 None 交给小模型。
+
+        评分严格高于 阈值+区间 才直接放行（默认 0.6+0.25，即需高于 0.85）。不在接机器人话头的消息
+        最高只能得到 0.85，因此默认配置下只有紧接机器人回复的消息才可能被直接放行。
+        直接放行的消息不经过人格设定判断。
+        """
+        local = self._local_score(event, chat_state, last_bot_reply)
+        reject_below = round(self.reply_threshold - self.local_gate_margin, 2)
+        accept_above = round(self.reply_threshold + self.local_gate_margin, 2)
+        if local < reject_below:
+            logger.debug(f"本地预判拒绝: {event.unified_msg_origin[:20]}... | 本地评分:{local:.2f}")
+            return JudgeResult(should_reply=False, confidence=local, overall_score=local, reasoning="本地预判：明显不适合回复")
+        # 过短的消息（如单个问号）本地信号不足以直接放行
+        if local > accept_above and len(event.message_str.strip()) >= _LOCAL_ACCEPT_MIN_LENGTH:
+            logger.debug(f"本地预判通过: {event.unified_msg_origin[:20]}... | 本地评分:{local:.2f}")
+            return JudgeResult(should_reply=True, confidence=local, overall_score=local, reasoning="本地预判：明显适合回复")
+        return None
+
+    def _build_judge_result(self, judge_data: dict) -> JudgeResult:
+        """根据小模型返回的单条评分计算综合评分并构建判断结果"""
+        # 直接从 JSON 根对象按维度顺序获取分数，并钉位到 [0, 10]
+        scores = tuple(_clamp_score(judge_data.get(k, 0)) for k in _SCORE_KEYS)
+        relevance, willingness, social, timing, continuity = scores
+
+        # 计算综合评分
+        overall_score = sum(score * weight for score, weight in zip(scores, self._weight_vec)) / 10.0
+
+        # 根据综合评分判断是否应该回复
+        should_reply = overall_score >= self.reply_threshold
+
+        logger.debug(f"小参数模型判断成功，综合评分: {overall_score:.3f}, 是否回复: {should_reply}")
+
+        return JudgeResult(
+            relevance=relevance,
+            willingness=willingness,
+            social=social,
+            timing=timing,
+            continuity=continuity,
+            reasoning=judge_data.get("reasoning", "") if self.judge_include_reasoning else "",
+            should_reply=should_reply,
+            confidence=overall_score,  # 使用综合评分作为置信度
+            overall_score=overall_score,
+            related_messages=[]  # 不再使用关联消息功能
+        )
+
+    @staticmethod
+    def _limit_batch_replies(results: list[JudgeResult]) -> list[JudgeResult]:
+        """同一批消息最多主动回复一次：只保留综合评分最高的一条，避免连续刷屏"""
+        candidates = [i for i, r in enumerate(results) if r.should_reply]
+        if len(candidates) <= 1:
+            return results
+        # 评分相同时优先回复较新的消息
+        best = max(reversed(candidates), key=lambda i: results[i].overall_score)
+        return [
+            replace(r, should_reply=False, reasoning=f"同批次已选择其他消息回复 | {r.reasoning}")
+            if i in candidates and i != best else r
+            for i, r in enumerate(results)
+        ]
+
+    async def _submit_judge(self, event: AstrMessageEvent) -> JudgeResult:
+        """将消息提交到所在群聊的判断队列，等待批量判断结果"""
+        if not self.judge_batch_window or self.judge_batch_size <= 1:
+            return await self.judge_with_tiny_model(event)
+
+        umo = event.unified_msg_origin
+        queue = self._judge_queues.get(umo)
+        if queue is None:
+            queue = self._judge_queues[umo] = asyncio.Queue()
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((event, future))
+        if umo not in self._judge_workers:
+            self._judge_workers[umo] = asyncio.create_task(self._judge_worker(umo, queue))
+        return await future
+
+    async def _judge_worker(self, umo: str, queue: asyncio.Queue) -> None:
+        """群聊判断工作协程：收集窗口期内的消息合并判断，队列清空后退出"""
+        batch: list[tuple[AstrMessageEvent, asyncio.Future]] = []
+        try:
+            while not queue.empty():
+                # 等到窗口截止时刻再一次性取出队列中的消息，不为每次等待创建和取消任务
+                if queue.qsize() < self.judge_batch_size:
+                    await asyncio.sleep(self.judge_batch_window)
+                while len(batch) < self.judge_batch_size and not queue.empty():
+                    batch.append(queue.get_nowait())
+
+                if len(batch) > 1:
+                    logger.debug(f"合并判断 {len(batch)} 条消息 | {umo[:20]}...")
+                try:
+                    results = await self.judge_batch_with_tiny_model([e for e, _ in batch])
+                except Exception as e:
+                    logger.error(f"批量判断异常: {e}")
+                    results = [JudgeResult(should_reply=False, reasoning=f"异常: {str(e)}") for _ in batch]
+
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+                batch = []
+        finally:
+            # 检查队列为空到移除工作协程之间没有 await，不会丢失新提交的消息
+            self._judge_workers.pop(umo, None)
+            self._judge_queues.pop(umo, None)
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
+
+    def _judge_cache_key(self, event: AstrMessageEvent, persona_digest: bytes, last_bot_reply: str | None) -> JudgeCacheKey:
+        """根据人格提示词摘要、群聊、归一化消息与上次机器人回复构建判断缓存键。
+
+        使用元组而非拼接字符串，字段之间不会因内容中含分隔符而产生歧义。
+        """
+        return (persona_digest, event.unified_msg_origin, _normalize_message(event.message_str), last_bot_reply)
+
+    def _judge_cache_get(self, key: JudgeCacheKey) -> JudgeResult | None:
+        """读取未过期的判断缓存，命中时刷新 LRU 顺序"""
+        if not self.judge_cache_ttl:
+            return None
+        entry = self.judge_cache.get(key)
+        if entry is None:
+            return None
+        cached_at, result = entry
+        if time.time() - cached_at > self.judge_cache_ttl:
+            del self.judge_cache[key]
+            return None
+        self.judge_cache.move_to_end(key)
+        return result
+
+    def _judge_cache_put(self, key: JudgeCacheKey, result: JudgeResult) -> None:
+        """写入判断缓存，超出容量时淘汰最久未使用的条目。
+
+        只缓存不回复的结果：回复与否还取决于精力等群聊状态，且机器人回复送达前缓存键不变，
+        复用"应回复"结果会让同一句话连续触发多次主动回复。
+        """
+        if not self.judge_cache_ttl or result.should_reply:
+            return
+        self.judge_cache[key] = (time.time(), result)
+        self.judge_cache.move_to_end(key)
+        while len(self.judge_cache) > self.judge_cache_size:
+            self.judge_cache.popitem(last=False)
 
     def _record_raw_message(self, event: AstrMessageEvent, is_bot: bool = False) -> None:
         """将消息写入原始消息缓冲区"""
-        umo = event.unified_msg_origin
-        if umo not in self._raw_msg_buffer:
-            self._raw_msg_buffer[umo] = deque(maxlen=self._raw_msg_buffer_size)
-        self._raw_msg_buffer[umo].append(RawMessage(
+        raw_msg = RawMessage(
             sender_name=event.get_sender_name(),
             sender_id=str(event.get_sender_id()),
             content=event.message_str,
             timestamp=time.time(),
             is_bot=is_bot,
-        ))
+        )
+        self._append_raw_message(event.unified_msg_origin, raw_msg)
+        # 记下该消息对应的缓冲区条目，构建判断上下文时据此截断历史
+        event.set_extra("heartflow_raw_msg", raw_msg)
+        # 同时记下写入时距机器人上次回复的消息数，批量判断时每条消息各自使用
+        event.set_extra("heartflow_msgs_since_bot", self._get_last_bot_msg(event.unified_msg_origin)[1])
+
+    def _append_raw_message(self, umo: str, msg: RawMessage) -> None:
+        """追加消息到缓冲区，并同步维护最近一条机器人回复的位置"""
+        if umo in self._raw_msg_buffer:
+            buffer = self._raw_msg_buffer[umo]
+        else:
+            buffer = self._raw_msg_buffer[umo] = deque(maxlen=self._raw_msg_buffer_size)
+        buffer.append(msg)
+
+        if msg.is_bot:
+            self._last_bot_msg[umo] = msg
+            self._msgs_since_bot_reply[umo] = 0
+        elif umo in self._msgs_since_bot_reply:
+            self._msgs_since_bot_reply[umo] += 1
+
+    def _get_last_bot_msg(self, umo: str) -> tuple[RawMessage | None, int]:
+        """获取缓冲区内最近一条机器人回复及其之后的用户消息数。
+
+        机器人回复已被挤出缓冲区时视为不存在，返回 (None, 0)。
+        """
+        msg = self._last_bot_msg.get(umo)
+        since = self._msgs_since_bot_reply.get(umo)
+        if msg is None or since is None or since >= self._raw_msg_buffer_size:
+            return None, 0
+        return msg, since
 
     def _get_raw_buffer(self, umo: str) -> list[RawMessage]:
         """获取缓冲区中的消息列表（时间顺序）"""
@@ -453,8 +840,8 @@ class HeartflowPlugin(star.Star):
         self._record_raw_message(event, is_bot=False)
 
         try:
-            # 小参数模型判断是否需要回复
-            judge_result = await self.judge_with_tiny_model(event)
+            # 小参数模型判断是否需要回复（同一群聊短时间内的消息会合并判断）
+            judge_result = await self._submit_judge(event)
 
             if judge_result.should_reply:
                 logger.info(f"🔥 心流触发主动回复 | {event.unified_msg_origin[:20]}... | 评分:{judge_result.overall_score:.2f}")
@@ -483,7 +870,7 @@ class HeartflowPlugin(star.Star):
     @filter.after_message_sent()
     async def on_after_message_sent(self, event: AstrMessageEvent):
         """在消息发送后将机器人的回复写入原始消息缓冲区，以便后续判断参考"""
-        if not self.config.get("enable_heartflow", False):
+        if not self.enable_heartflow:
             return
 
         result = event.get_result()
@@ -498,9 +885,7 @@ class HeartflowPlugin(star.Star):
             return
 
         umo = event.unified_msg_origin
-        if umo not in self._raw_msg_buffer:
-            self._raw_msg_buffer[umo] = deque(maxlen=self._raw_msg_buffer_size)
-        self._raw_msg_buffer[umo].append(RawMessage(
+        self._append_raw_message(umo, RawMessage(
             sender_name="bot",
             sender_id="bot",
             content=reply_text,
@@ -523,7 +908,7 @@ class HeartflowPlugin(star.Star):
         """检查是否应该处理这条消息"""
 
         # 检查插件是否启用
-        if not self.config.get("enable_heartflow", False):
+        if not self.enable_heartflow:
             return False
 
         # 跳过已经被其他插件或系统标记为唤醒的消息
@@ -531,6 +916,14 @@ class HeartflowPlugin(star.Star):
             logger.debug(f"跳过已被标记为唤醒的消息: {event.message_str}")
             return False
 
+        # 跳过机器人自己的消息
+        if event.get_sender_id() == event.get_self_id():
+            return False
+
+        # 跳过空消息
+        if not event.message_str or not event.message_str.strip():
+            return False
+
         # 检查白名单
         if self.whitelist_enabled:
             if not self.chat_whitelist:
@@ -541,14 +934,6 @@ class HeartflowPlugin(star.Star):
                 logger.debug(f"群聊不在白名单中，跳过处理: {event.unified_msg_origin}")
                 return False
 
-        # 跳过机器人自己的消息
-        if event.get_sender_id() == event.get_self_id():
-            return False
-
-        # 跳过空消息
-        if not event.message_str or not event.message_str.strip():
-            return False
-
         # 冷却时间校验：防止短时间内连续触发
         if self.min_reply_interval > 0:
             minutes = self._get_minutes_since_last_reply(event.unified_msg_origin)
@@ -565,7 +950,7 @@ class HeartflowPlugin(star.Star):
             self.chat_states[chat_id] = ChatState()
 
         # 检查日期重置
-        today = datetime.date.today().isoformat()
+        today = self._now_strings()[2]
         state = self.chat_states[chat_id]
 
         if state.last_reset_date != today:
@@ -575,13 +960,25 @@ class HeartflowPlugin(star.Star):
 
         # 基于时间流逝自然恢复精力（距上次回复每过 5 分钟回复 1% 精力）
         if state.last_reply_time > 0:
-            elapsed_minutes = (time.time() - state.last_reply_time) / 60.0
+            now = time.time()
+            since = max(state.last_reply_time, state.energy_updated_at)
+            elapsed_minutes = (now - since) / 60.0
             time_recovery = elapsed_minutes * (self.energy_recovery_rate * 5)
             state.energy = min(1.0, state.energy + time_recovery)
-            state.last_reply_time = time.time()  # 重置计时起点，避免重复累加
+            state.energy_updated_at = now  # 重置计时起点，避免重复累加
 
         return state
 
+    def _now_strings(self) -> tuple[str, str, str]:
+        """获取当前时间的格式化字符串 ("HH:MM", "HH:MM:SS", "YYYY-MM-DD")，1 秒内复用缓存"""
+        now = time.time()
+        cached_at, strings = self._clock_cache
+        if strings is None or now - cached_at >= 1.0:
+            dt = datetime.datetime.fromtimestamp(now)
+            strings = (dt.strftime("%H:%M"), dt.strftime("%H:%M:%S"), dt.date().isoformat())
+            self._clock_cache = (now, strings)
+        return strings
+
     def _get_minutes_since_last_reply(self, chat_id: str) -> int:
         """获取距离上次回复的分钟数"""
         chat_state = self._get_chat_state(chat_id)
@@ -591,67 +988,57 @@ class HeartflowPlugin(star.Star):
 
         return int((time.time() - chat_state.last_reply_time) / 60)
 
-    def _get_recent_contexts(self, event: AstrMessageEvent) -> list:
-        """从原始消息缓冲区获取最近对话上下文（用于传递给小参数模型）。
-
-        使用本地缓冲区而非 conversation_manager，以便包含所有群聊消息，
-        而不仅仅是触发过 LLM 的消息。
-        """
+    def _get_recent_raw(self, event: AstrMessageEvent) -> list[RawMessage]:
+        """获取当前消息之前的最近若干条原始消息。"""
         msgs = self._get_raw_buffer(event.unified_msg_origin)
-        # 排除当前这条消息（已被 _record_raw_message 写入），取之前的若干条
-        if msgs and msgs[-1].content == event.message_str:
+        # 排除当前这条消息（已被 _record_raw_message 写入）及之后到达的消息，取之前的若干条
+        raw_msg = event.get_extra("heartflow_raw_msg")
+        if raw_msg is not None:
+            for i in range(len(msgs) - 1, -1, -1):
+                if msgs[i] is raw_msg:
+                    msgs = msgs[:i]
+                    break
+            else:
+                msgs = []
+        elif msgs and msgs[-1].content == event.message_str:
             msgs = msgs[:-1]
-        recent = msgs[-self.context_messages_count:] if len(msgs) > self.context_messages_count else msgs
+        return msgs[-self.context_messages_count:] if len(msgs) > self.context_messages_count else msgs
 
-        contexts = []
-        for m in recent:
-            role = "assistant" if m.is_bot else "user"
-            contexts.append({"role": role, "content": m.content})
-        return contexts
-
-    def _get_recent_messages(self, event: AstrMessageEvent) -> str:
-        """从原始消息缓冲区获取最近的消息历史（用于小参数模型判断）。
+    def _gather_judge_inputs(self, event: AstrMessageEvent, anchor: AstrMessageEvent | None = None) -> JudgeInputs:
+        """一次性构建判断所需的全部上下文。
 
-        包含所有群聊成员的消息，而非仅 LLM 处理过的消息。
+        使用本地缓冲区而非 conversation_manager，以便包含所有群聊消息，
+        而不仅仅是触发过 LLM 的消息。对话历史取 anchor（默认为 event）之前的若干条，
+        文本历史与传给小参数模型的上下文在同一次遍历中生成。
         """
-        msgs = self._get_raw_buffer(event.unified_msg_origin)
-        # 排除当前这条消息（已被 _record_raw_message 写入），取之前的若干条
-        if msgs and msgs[-1].content == event.message_str:
-            msgs = msgs[:-1]
-        recent = msgs[-self.context_messages_count:] if len(msgs) > self.context_messages_count else msgs
-
-        if not recent:
-            return "暂无对话历史"
+        recent = self._get_recent_raw(anchor or event)
 
         lines = []
+        contexts = []
         for m in recent:
-            prefix = "[机器人]" if m.is_bot else f"[{m.sender_name}]"
-            lines.append(f"{prefix}: {m.content}")
-        return "\n".join(lines)
+            lines.append(m.line)
+            contexts.append({"role": "assistant" if m.is_bot else "user", "content": m.content})
+
+        return JudgeInputs(
+            chat_context=self._build_chat_context(event),
+            recent_messages="\n".join(lines) if lines else "暂无对话历史",
+            last_bot_reply=self._get_last_bot_reply(event),
+            recent_contexts=contexts,
+        )
 
     def _get_last_bot_reply(self, event: AstrMessageEvent) -> str | None:
         """从原始消息缓冲区获取上次机器人的回复内容。"""
-        msgs = self._get_raw_buffer(event.unified_msg_origin)
-        for m in reversed(msgs):
-            if m.is_bot and m.content.strip():
-                return m.content
-        return None
+        msg, _ = self._get_last_bot_msg(event.unified_msg_origin)
+        return msg.content if msg else None
 
     def _build_chat_context(self, event: AstrMessageEvent) -> str:
         """构建群聊上下文摘要信息。"""
         chat_state = self._get_chat_state(event.unified_msg_origin)
 
         # 检查上次机器人回复后群里有没有人接话（评估回复质量）
-        msgs = self._get_raw_buffer(event.unified_msg_origin)
         post_reply_engagement = ""
-        found_bot = False
-        user_msgs_after_bot = 0
-        for m in reversed(msgs):
-            if m.is_bot:
-                found_bot = True
-                break
-            user_msgs_after_bot += 1
-        if found_bot:
+        last_bot_msg, user_msgs_after_bot = self._get_last_bot_msg(event.unified_msg_origin)
+        if last_bot_msg is not None:
             if user_msgs_after_bot >= 3:
                 post_reply_engagement = "（上次回复后群里进行了热烈讨论）"
             elif user_msgs_after_bot == 0:
@@ -665,8 +1052,8 @@ class HeartflowPlugin(star.Star):
             activity_level = "低"
 
         context_info = f"最近活跃度: {activity_level}\n"
-        context_info += f"历史回复率: {(chat_state.total_replies / max(1, chat_state.total_messages) * 100):.1f}%\n"
-        context_info += f"当前时间: {datetime.datetime.now().strftime('%H:%M')}"
+        context_info += f"历史回复率: {chat_state.reply_rate:.1f}%\n"
+        context_info += f"当前时间: {self._now_strings()[0]}"
 
         if post_reply_engagement:
             context_info += f"\n回复效果: {post_reply_engagement}"
@@ -701,6 +1088,11 @@ class HeartflowPlugin(star.Star):
 
         logger.debug(f"更新被动状态: {chat_id[:20]}... | 精力: {chat_state.energy:.2f} | 原因: {judge_result.reasoning[:30]}...")
 
+    async def terminate(self):
+        """插件卸载时停止所有判断工作协程和后台总结任务"""
+        for task in [*self._judge_workers.values(), *self._summarize_tasks.values()]:
+            task.cancel()
+
     # 管理员命令：查看心流状态
     @filter.command("heartflow")
     async def heartflow_status(self, event: AstrMessageEvent):
@@ -720,7 +1112,7 @@ class HeartflowPlugin(star.Star):
 📈 **历史统计**
 - 总消息数: {chat_state.total_messages}
 - 总回复数: {chat_state.total_replies}
-- 回复率: {(chat_state.total_replies / max(1, chat_state.total_messages) * 100):.1f}%
+- 回复率: {chat_state.reply_rate:.1f}%
 
 ⚙️ **配置参数**
 - 回复阈值: {self.reply_threshold}
@@ -731,6 +1123,7 @@ class HeartflowPlugin(star.Star):
 
 🧠 **智能缓存**
 - 系统提示词缓存: {len(self.system_prompt_cache)} 个
+- 判断结果缓存: {len(self.judge_cache)} 个
 
 🎯 **评分权重**
 - 内容相关度: {self.weights['relevance']:.0%}
@@ -739,7 +1132,7 @@ class HeartflowPlugin(star.Star):
 - 时机恰当性: {self.weights['timing']:.0%}
 - 对话连贯性: {self.weights['continuity']:.0%}
 
-🎯 **插件状态**: {'✅ 已启用' if self.config.get('enable_heartflow', False) else '❌ 已禁用'}
+🎯 **插件状态**: {'✅ 已启用' if self.enable_heartflow else '❌ 已禁用'}
 """
 
         event.set_result(event.plain_result(status_info))
@@ -760,28 +1153,55 @@ class HeartflowPlugin(star.Star):
     # 管理员命令：查看系统提示词缓存
     @filter.permission_type(filter.PermissionType.ADMIN)
     @filter.command("heartflow_cache")
-    async def heartflow_cache_status(self, event: AstrMessageEvent):
-        """查看系统提示词缓存状态"""
-        
-        cache_info = "🧠 系统提示词缓存状态\n\n"
+    async def heartflow_cache_status(self, event: AstrMessageEvent, limit: int = 20):
+        """查看系统提示词缓存状态，按原始提示词长度从大到小最多显示 limit 条"""
         
         if not self.system_prompt_cache:
-            cache_info += "📭 当前无缓存记录"
-        else:
-            cache_info += f"📝 总缓存数量: {len(self.system_prompt_cache)}\n\n"
-            
-            for cache_key, cache_data in self.system_prompt_cache.items():
-                original_len = len(cache_data.get("original", ""))
-                summarized_len = len(cache_data.get("summarized", ""))
-                persona_id = cache_data.get("persona_id", "unknown")
-                
-                cache_info += f"🔑 **缓存键**: {cache_key}\n"
-                cache_info += f"👤 **人格ID**: {persona_id}\n"
-                cache_info += f"📏 **压缩率**: {original_len} -> {summarized_len} ({(1-summarized_len/max(1,original_len))*100:.1f}% 压缩)\n"
-                cache_info += f"📄 **精简内容**: {cache_data.get('summarized', '')[:100]}...\n\n"
-        
+            event.set_result(event.plain_result(_CACHE_REPORT_EMPTY))
+            return
+
+        total = len(self.system_prompt_cache)
+        limit = max(1, limit)
+        parts = [_CACHE_REPORT_HEADER, f"📝 总缓存数量: {total}\n\n"]
+
+        items = heapq.nlargest(limit, self.system_prompt_cache.items(), key=lambda kv: kv[1].get("orig_len", 0))
+        for cache_key, cache_data in items:
+            summarized = cache_data.get("summarized", "")
+            original_len = cache_data.get("orig_len", 0)
+            summarized_len = len(summarized)
+            persona_id = cache_data.get("persona_id", "unknown")
+            ratio = (1 - summarized_len / original_len) * 100.0 if original_len else 0.0
+            preview = summarized[:100]
+
+            parts.append(
+                f"🔑 **缓存键**: {cache_key}\n"
+                f"👤 **人格ID**: {persona_id}\n"
+                f"📏 **压缩率**: {original_len} -> {summarized_len} ({ratio:.1f}% 压缩)\n"
+                f"📄 **精简内容**: {preview}...\n\n"
+            )
+
+        if total > limit:
+            parts.append(f"... 还有 {total - limit} 条省略\n")
+
+        cache_info = "".join(parts)
         event.set_result(event.plain_result(cache_info))
 
+    # 管理员命令：调整系统提示词缓存容量
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("heartflow_cache_config")
+    async def heartflow_cache_config(self, event: AstrMessageEvent, max_entries: int = 0):
+        """查看或调整系统提示词缓存容量（仅本次运行有效）"""
+
+        if max_entries <= 0:
+            event.set_result(event.plain_result(
+                f"📦 系统提示词缓存容量: {self.system_prompt_cache.maxsize}，当前 {len(self.system_prompt_cache)} 个"
+            ))
+            return
+
+        self.system_prompt_cache.resize(max_entries)
+        event.set_result(event.plain_result(f"✅ 系统提示词缓存容量已设置为 {max_entries}"))
+        logger.info(f"系统提示词缓存容量已调整为 {max_entries}")
+
     # 管理员命令：清除系统提示词缓存
     @filter.permission_type(filter.PermissionType.ADMIN)
     @filter.command("heartflow_cache_clear")
@@ -790,39 +1210,86 @@ class HeartflowPlugin(star.Star):
         
         cache_count = len(self.system_prompt_cache)
         self.system_prompt_cache.clear()
+        self._persona_prompt_lru.clear()
         
-        event.set_result(event.plain_result(f"✅ 已清除 {cache_count} 个系统提示词缓存"))
-        logger.info(f"系统提示词缓存已清除，共清除 {cache_count} 个缓存")
+        msg = f"✅ 已清除 {cache_count} 个系统提示词缓存"
+        event.set_result(event.plain_result(msg))
+        logger.info("系统提示词缓存已清除，共清除 %d 个缓存", cache_count)
+
+    # 管理员命令：重建人格提示词索引
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("heartflow_persona_reindex")
+    async def heartflow_persona_reindex(self, event: AstrMessageEvent):
+        """重建人格提示词索引（修改人格内容后使用）"""
+
+        self._persona_prompt_index = None
+        self._persona_prompt_lru.clear()
+
+        event.set_result(event.plain_result("✅ 人格提示词索引已重建"))
+        logger.info("人格提示词索引已重建")
 
     async def _get_persona_system_prompt(self, event: AstrMessageEvent) -> str:
         """获取当前对话的人格系统提示词"""
         try:
             persona_mgr = self.context.persona_manager
+            conv_mgr = self.context.conversation_manager
 
-            # 获取当前对话，尝试拿到会话绑定的 persona_id
-            curr_cid = await self.context.conversation_manager.get_curr_conversation_id(event.unified_msg_origin)
+            # 尝试拿到会话绑定的 persona_id（/persona 切换人格时会话ID不变，需每次读取）
+            umo = event.unified_msg_origin
+            curr_cid = await conv_mgr.get_curr_conversation_id(umo)
             persona_id: str | None = None
             if curr_cid:
-                conversation = await self.context.conversation_manager.get_conversation(event.unified_msg_origin, curr_cid)
+                conversation = await conv_mgr.get_conversation(umo, curr_cid)
                 if conversation:
                     persona_id = conversation.persona_id
 
-            # 用户显式取消人格
-            if persona_id == "[%None]":
-                return ""
+            # 会话ID与人格ID均未变化时直接使用缓存的人格提示词，省去人格查询
+            if umo in self._persona_prompt_lru:
+                cached_cid, cached_persona_id, cached_prompt = self._persona_prompt_lru[umo]
+                if cached_cid == curr_cid and cached_persona_id == persona_id:
+                    return cached_prompt
 
-            if persona_id:
-                # 直接通过 PersonaManager 查询数据库
-                try:
-                    persona = await persona_mgr.get_persona(persona_id)
-                    return persona.system_prompt or ""
-                except ValueError:
-                    logger.debug(f"未找到人格 {persona_id}，回退到默认人格")
+            prompt = None
+            if persona_id is _PERSONA_NONE or persona_id == _PERSONA_NONE:
+                # 用户显式取消人格
+                prompt = ""
+            elif persona_id:
+                prompt = await self._get_persona_prompt_by_id(persona_id)
+
+            if prompt is None:
+                # 无 persona_id 或查询失败，使用默认人格
+                default_persona = await persona_mgr.get_default_persona_v3(umo)
+                prompt = default_persona.get("prompt", "")
 
-            # 无 persona_id 或查询失败，使用默认人格
-            default_persona = await persona_mgr.get_default_persona_v3(event.unified_msg_origin)
-            return default_persona.get("prompt", "")
+            self._persona_prompt_lru[umo] = (curr_cid, persona_id, prompt)
+            return prompt
 
         except Exception as e:
-            logger.debug(f"获取人格系统提示词失败: {e}")
+            logger.debug("获取人格系统提示词失败: %s", e)
             return ""
+
+    async def _get_persona_prompt_by_id(self, persona_id: str) -> str | None:
+        """按人格ID获取系统提示词，查询结果记入索引；未找到时返回 None"""
+        persona_mgr = self.context.persona_manager
+
+        # 人格数量变化（新增/删除人格）时重建索引
+        personas = getattr(persona_mgr, "personas", None)
+        personas_len = len(personas) if personas is not None else -1
+        if self._persona_prompt_index is None or personas_len != self._persona_prompt_index_len:
+            self._persona_prompt_index = {}
+            self._persona_prompt_index_len = personas_len
+
+        prompt = self._persona_prompt_index.get(persona_id)
+        if prompt is not None:
+            return prompt
+
+        # 索引未命中时通过 PersonaManager 查询数据库
+        try:
+            persona = await persona_mgr.get_persona(persona_id)
+        except ValueError:
+            logger.debug("未找到人格 %s，回退到默认人格", persona_id)
+            return None
+
+        prompt = persona.system_prompt or ""
+        self._persona_prompt_index[persona_id] = prompt
+        return prompt